@@ -1,11 +1,18 @@
 import streamlit as st
 import pandas as pd
-import akshare as ak
+import numpy as np
 import datetime
 import time
+import os
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import random
 import requests
+from requests.adapters import HTTPAdapter
 import re
 import io
+import logging
 
 # ----------------------------------------------------------------------------- 
 # 0. 全局配置
@@ -16,62 +23,107 @@ st.set_page_config(
     layout="wide",
     initial_sidebar_state="expanded"
 )
+logger = logging.getLogger("hunter")
 
 # ----------------------------------------------------------------------------- 
 # 1. 极速搜索核心 (新浪/腾讯)
 # -----------------------------------------------------------------------------
+SINA_RE = re.compile(r'"([^"]*)"')
+TENCENT_RE = re.compile(r'v_hint="([^"]*)"')
+
+@st.cache_resource
+def get_http_session():
+    """进程级共享 Session (keep-alive 连接池); 脚本每次重跑都会重新执行, 故用 cache_resource 持有"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=8, pool_maxsize=8)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+@st.cache_data(ttl=3600, max_entries=512, show_spinner=False)
 def search_sina(key):
-    """新浪接口搜索"""
-    try:
-        url = f"http://suggest3.sinajs.cn/suggest/type=&key={key}&name=suggestdata_{int(time.time())}"
-        headers = {'Referer': 'http://finance.sina.com.cn/'} 
-        r = requests.get(url, headers=headers, timeout=2)
-        match = re.search(r'"(.*?)"', r.text)
-        if match:
-            items = match.group(1).split(';')
-            for item in items:
-                parts = item.split(',')
-                if len(parts) > 4:
-                    full_code = parts[3] # 如 sh600519
-                    if full_code.startswith(('sh6', 'sz0', 'sz3', 'bj4', 'bj8')):
-                        return full_code[2:], parts[4], "新浪接口"
-    except: pass
+    """新浪接口搜索; 网络异常向上抛出, 不进缓存"""
+    url = f"http://suggest3.sinajs.cn/suggest/type=&key={key}&name=suggestdata_{int(time.time())}"
+    headers = {'Referer': 'http://finance.sina.com.cn/'} 
+    r = get_http_session().get(url, headers=headers, timeout=2)
+    r.raise_for_status()
+    match = SINA_RE.search(r.text)
+    if match:
+        items = match.group(1).split(';')
+        for item in items:
+            parts = item.split(',')
+            if len(parts) > 4:
+                full_code = parts[3] # 如 sh600519
+                if full_code.startswith(('sh6', 'sz0', 'sz3', 'bj4', 'bj8')):
+                    return full_code[2:], parts[4], "新浪接口"
     return None
 
+@st.cache_data(ttl=3600, max_entries=512, show_spinner=False)
 def search_tencent(key):
-    """腾讯接口搜索"""
-    try:
-        url = f"http://smartbox.gtimg.cn/s3/?v=2&q={key}&t=all"
-        r = requests.get(url, timeout=2)
-        if 'v_hint="' in r.text:
-            raw = r.text.split('v_hint="')[1].split('"')[0]
-            parts = raw.split('^')[0].split('~')
-            if len(parts) >= 3:
-                return parts[2], parts[1], "腾讯接口"
-    except: pass
+    """腾讯接口搜索; 网络异常向上抛出, 不进缓存"""
+    url = f"http://smartbox.gtimg.cn/s3/?v=2&q={key}&t=all"
+    r = get_http_session().get(url, timeout=2)
+    r.raise_for_status()
+    match = TENCENT_RE.search(r.text)
+    if match:
+        parts = match.group(1).split('^')[0].split('~')
+        if len(parts) >= 3:
+            return parts[2], parts[1], "腾讯接口"
     return None
 
 def get_stock_info_fast(query):
-    res = search_sina(query)
-    if res: return res
-    res = search_tencent(query)
-    if res: return res
+    """新浪/腾讯同时发起, 仍以新浪结果优先; 最坏耗时由两次超时相加变为一次"""
+    # 每次调用独立的线程池: 进程级共享池会让各会话的查询互相排队
+    pool = ThreadPoolExecutor(max_workers=2)
+    futures = [(pool.submit(search_sina, query), "新浪"), (pool.submit(search_tencent, query), "腾讯")]
+    pool.shutdown(wait=False)  # 新浪命中即返回, 不等腾讯收尾
+    deadline = time.time() + 3  # 整体兜底: 单个请求卡住也不拖住页面 (requests 的 timeout 只管单次读写)
+    for future, label in futures:
+        try:
+            res = future.result(timeout=max(0, deadline - time.time()))
+        except Exception as e:
+            logger.warning("%s搜索失败 %s: %s", label, query, e)
+            continue
+        if res: return res
     return None, None, None
 
+def is_a_share_code(code):
+    """6 位纯数字才是 A 股代码; 其余 (港美股/半截输入) 不发起任何数据请求"""
+    return bool(code) and len(code) == 6 and code.isdigit()
+
 # ----------------------------------------------------------------------------- 
 # 2. 数据处理与指标计算
 # -----------------------------------------------------------------------------
+def prefix_sum(arr):
+    """前缀和与有效值计数 (首位补 0, NaN 按 0 累加), 一次遍历供多个窗口复用"""
+    return np.concatenate(([0.0], np.nancumsum(arr))), np.concatenate(([0], np.cumsum(~np.isnan(arr))))
+
+def rolling_mean(sums, w):
+    """由前缀和求 O(n) 滑动均值; 窗口内不足 w 个有效值记 NaN, 与 rolling(w).mean() 对齐"""
+    csum, cnt = sums
+    out = np.full(csum.size - 1, np.nan)
+    out[w-1:] = np.where(cnt[w:] - cnt[:-w] == w, (csum[w:] - csum[:-w]) / w, np.nan)
+    return out
+
+def rolling_std(arr, w):
+    """由 x 与 x² 的前缀和求 O(n) 滑动样本标准差, 与 rolling(w).std() 对齐; 先减均值以减小相减误差"""
+    dev = arr - np.nanmean(arr)
+    var = rolling_mean(prefix_sum(dev * dev), w) - rolling_mean(prefix_sum(dev), w) ** 2
+    return np.sqrt(np.clip(var, 0, None) * w / (w - 1))
+
 def add_technical_indicators(df):
     try:
         close = df['close']
         # MACD
         ema12 = close.ewm(span=12, adjust=False).mean()
         ema26 = close.ewm(span=26, adjust=False).mean()
-        df['DIF'] = ema12 - ema26
-        df['DEA'] = df['DIF'].ewm(span=9, adjust=False).mean()
-        df['MACD'] = (df['DIF'] - df['DEA']) * 2
+        dif = ema12 - ema26
+        dea = dif.ewm(span=9, adjust=False).mean()
+        df['DIF'], df['DEA'], df['MACD'] = dif, dea, (dif - dea) * 2
         # MA
-        for w in [5, 10, 20, 60]: df[f'MA{w}'] = close.rolling(window=w).mean()
+        c = close.to_numpy(dtype=float)
+        sums = prefix_sum(c)
+        for w in [5, 10, 20, 60]: df[f'MA{w}'] = rolling_mean(sums, w)
         # KDJ
         low_min = df['low'].rolling(9).min()
         high_max = df['high'].rolling(9).max()
@@ -87,65 +139,172 @@ def add_technical_indicators(df):
             ma_up = up.ewm(com=p-1, adjust=False).mean()
             ma_down = down.ewm(com=p-1, adjust=False).mean()
             df[f'RSI_{p}'] = ma_up / (ma_up + ma_down) * 100
-        # BOLL
-        mid = close.rolling(20).mean()
-        std = close.rolling(20).std()
+        # BOLL (中轨即 MA20)
+        mid = df['MA20'].to_numpy()
+        std = rolling_std(c, 20)
         df['BOLL_UP'] = mid + 2*std
         df['BOLL_LO'] = mid - 2*std
         # VWAP (日内)
         if 'amount' in df.columns:
-            df['VWAP'] = df.apply(lambda x: x['amount']/x['volume'] if x['volume']>0 else x['close'], axis=1)
-    except: pass
+            vol, amt = df['volume'].to_numpy(dtype=float), df['amount'].to_numpy(dtype=float)
+            # 只在有成交的位置做除法, 无成交日保留预填的收盘价 (copy: 不能写回 close 列本身)
+            vwap = df['close'].to_numpy(dtype=float, copy=True)
+            np.divide(amt, vol, out=vwap, where=vol > 0)
+            df['VWAP'] = vwap
+    except Exception as e: logger.warning("指标计算失败: %s", e)
     return df
 
+# 东财中文列 / 新浪英文列 -> 统一列名 (模块级常量, 不必每次调用重建)
+COL_MAP = {
+    '日期':'trade_date', 'date':'trade_date', '开盘':'open', 'open':'open',
+    '收盘':'close', 'close':'close', '最高':'high', 'high':'high', '最低':'low', 'low':'low',
+    '成交量':'volume', 'volume':'volume', '成交额':'amount', 'amount':'amount',
+    '换手率':'turnover', '涨跌幅':'pct_chg'
+}
+
 def clean_data(df):
-    col_map = {
-        '日期':'trade_date', 'date':'trade_date', '开盘':'open', 'open':'open',
-        '收盘':'close', 'close':'close', '最高':'high', 'high':'high', '最低':'low', 'low':'low',
-        '成交量':'volume', 'volume':'volume', '成交额':'amount', 'amount':'amount',
-        '换手率':'turnover', '涨跌幅':'pct_chg'
-    }
-    df = df.rename(columns=col_map)
+    df = df.rename(columns=COL_MAP)
     if 'trade_date' in df:
         df['trade_date'] = pd.to_datetime(df['trade_date'])
         df = df.sort_values('trade_date').reset_index(drop=True)
+    # 新浪日线不带涨跌幅, 统一补成数值列, 展示层不再做缺省判断
+    if 'pct_chg' not in df and 'close' in df:
+        df['pct_chg'] = df['close'].pct_change() * 100
     return df
 
 # ----------------------------------------------------------------------------- 
 # 3. 数据获取引擎
 # -----------------------------------------------------------------------------
-@st.cache_data(ttl=300)
+MAX_DAYS = 2000  # 侧边栏天数上限, 也是实际拉取的历史长度
+CACHE_DIR = os.path.expanduser("~/.stockhunter_cache")
+
+def disk_cached(ttl):
+    """parquet 落盘缓存: 进程重启/重新部署后仍可命中; 按文件 mtime 判断过期, 只在被调用时刷新"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args):
+            path = os.path.join(CACHE_DIR, func.__name__, "_".join(map(str, args)) + ".parquet")
+            try:
+                if time.time() - os.path.getmtime(path) < ttl:
+                    return pd.read_parquet(path)
+            except Exception: pass  # 无文件/读失败: 当作未命中
+            df = func(*args)
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"  # 先写临时文件再替换, 避免并发读到半截文件
+                df.to_parquet(tmp)
+                os.replace(tmp, path)
+                # 文件名带起止日期, 每天都会换新文件: 写入后顺手清掉本目录下已过期的旧文件, 防止无限堆积
+                now = time.time()
+                for entry in os.scandir(os.path.dirname(path)):
+                    try:
+                        if now - entry.stat().st_mtime >= ttl: os.remove(entry.path)
+                    except OSError: pass  # 已被其他会话删除等, 忽略
+            except Exception as e: logger.warning("写入磁盘缓存失败 %s: %s", path, e)
+            return df
+        return wrapper
+    return decorator
+
+@st.cache_resource
+def get_breakers():
+    """进程级熔断状态 ({name: {'fails', 'opened_at'}}, 锁); 放在 cache_resource 里, 跨会话/重跑共享"""
+    return {}, threading.Lock()
+
+# 只有传输层错误才算数据源故障; 空表/解析异常多是代码不存在等输入问题, 不能让一个用户把全站熔断
+BREAKER_ERRORS = (requests.RequestException, TimeoutError)
+
+def breaker(name, failure_threshold=5, reset_timeout=60):
+    """熔断器: 连续传输失败 failure_threshold 次后打开, reset_timeout 秒内直接快速失败, 到期放行一次探测 (半开)"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args):
+            states, lock = get_breakers()
+            with lock:
+                state = states.setdefault(name, {'fails': 0, 'opened_at': None})
+                if state['opened_at'] is not None:
+                    if time.time() - state['opened_at'] < reset_timeout:
+                        raise RuntimeError("连续失败已熔断, 暂时跳过")
+                    state['opened_at'] = time.time()  # 半开: 只放这一次探测, 并发请求仍快速失败
+            try:
+                result = func(*args)
+            except BREAKER_ERRORS:
+                with lock:
+                    state['fails'] += 1
+                    if state['fails'] >= failure_threshold: state['opened_at'] = time.time()
+                raise
+            except Exception:
+                # 数据源有应答 (如空表), 同成功一样清零并关闭熔断, 半开探测不会卡住
+                with lock: state['fails'], state['opened_at'] = 0, None
+                raise
+            with lock: state['fails'], state['opened_at'] = 0, None
+            return result
+        return wrapper
+    return decorator
+
+# 新浪行情代码前缀: 6 开头沪市, 8/4 开头北交所, 其余深市
+SINA_PREFIX = {'6': 'sh', '8': 'bj', '4': 'bj'}
+
+def get_symbol_prefix(code):
+    return SINA_PREFIX.get(code[:1], 'sz')
+
+def call_with_retry(func, *args, retries=2, base=0.2, **kwargs):
+    """仅对连接类瞬时错误重试 (指数退避 + 抖动); 读超时不重试, 让降级尽快生效"""
+    for attempt in range(retries + 1):
+        try:
+            return func(*args, **kwargs)
+        except requests.ConnectionError:
+            if attempt == retries: raise
+            time.sleep(base * 2 ** attempt + random.random() * 0.1)
+
+@st.cache_data(ttl=300, show_spinner=False)
+@disk_cached(ttl=300)
+@breaker("em_hist")
+def fetch_daily_em(code, s_str, e_str):
+    """东财日线 (前复权) + 指标. 失败/空表直接抛异常: 异常不会进缓存, 下次重跑自动重试"""
+    import akshare as ak  # 依赖树很重, 推迟到首次拉数据时再导入, 侧边栏先渲染
+    df = call_with_retry(ak.stock_zh_a_hist, symbol=code, period="daily", start_date=s_str, end_date=e_str, adjust="qfq", timeout=5)
+    if df is None or df.empty: raise ValueError("返回空数据")
+    # 指标随原始数据一起缓存, 按 (code, 起止日期) 命中, 无需再哈希整张表
+    return add_technical_indicators(clean_data(df))
+
+@st.cache_data(ttl=300, show_spinner=False)
+@disk_cached(ttl=300)
+@breaker("sina_daily")
+def fetch_daily_sina(code, s_str, e_str):
+    """新浪日线 (前复权) + 指标, 缓存语义同上"""
+    import akshare as ak
+    df = call_with_retry(ak.stock_zh_a_daily, symbol=get_symbol_prefix(code) + code, start_date=s_str, end_date=e_str, adjust="qfq")
+    if df is None or df.empty: raise ValueError("返回空数据")
+    return add_technical_indicators(clean_data(df))
+
 def fetch_stock_history(code, days):
     end_dt = datetime.datetime.now()
     start_dt = end_dt - datetime.timedelta(days=days)
-    s_str, e_str = start_dt.strftime("%Y%m%d"), end_dt.strftime("%Y%m%d")
+    # 统一按最长窗口拉取并算指标, 再按天数切片: 改天数直接命中缓存, 且窗口首日的 MA/MACD 已预热
+    s_str = (end_dt - datetime.timedelta(days=MAX_DAYS)).strftime("%Y%m%d")
+    e_str = end_dt.strftime("%Y%m%d")
     
     logs = []
     df = None
     
-    # 东财 -> 新浪
+    # 东财 -> 新浪 (缓存在各数据源这一层, 任一源失败都不会污染缓存)
     try:
-        df = ak.stock_zh_a_hist(symbol=code, period="daily", start_date=s_str, end_date=e_str, adjust="qfq")
-        if df is not None and not df.empty:
-            df = clean_data(df)
-            logs.append("✅ 来源: 东方财富")
+        df = fetch_daily_em(code, s_str, e_str)
+        logs.append("✅ 来源: 东方财富")
     except Exception as e:
         logs.append(f"⚠️ 东财无响应: {e}")
         
     if df is None:
         try:
-            prefix = "sh" if code.startswith('6') else ("bj" if code.startswith(('8','4')) else "sz")
-            df = ak.stock_zh_a_daily(symbol=f"{prefix}{code}", start_date=s_str, end_date=e_str, adjust="qfq")
-            if df is not None and not df.empty:
-                df = clean_data(df)
-                logs.append("✅ 来源: 新浪财经")
+            df = fetch_daily_sina(code, s_str, e_str)
+            logs.append("✅ 来源: 新浪财经")
         except Exception as e:
             logs.append(f"⚠️ 新浪无响应: {e}")
 
     if df is None: return None, "无法连接数据源", logs
-        
-    df = add_technical_indicators(df)
-    return df, None, logs
+    lo = df['trade_date'].searchsorted(pd.Timestamp(start_dt.date()))  # trade_date 已升序
+    if lo == len(df): return None, "所选区间内无交易数据", logs
+    return df.iloc[lo:].reset_index(drop=True), None, logs
 
 # ----------------------------------------------------------------------------- 
 # 4. Prompt 生成器 (核心)
@@ -186,6 +345,22 @@ def generate_ai_prompt(name, code, days):
 5. 结论建议（理性客观，不构成绝对喊单）
 """
 
+def build_ai_dataset(df, code, name, days):
+    """补全代码/名称, 并把 AI Prompt 注入到新的一列"""
+    df['code'] = code
+    df['name'] = name
+    # 我们把 Prompt 放在第一列或者最后一列，Gemini 都能读到
+    df['AI_ANALYSIS_PROMPT'] = generate_ai_prompt(name, code, days)
+    return df
+
+def export_csv(df):
+    """下载用 CSV 字节; 直接用页面上已构建好的表, 每次点击只生成一次并存进会话, 重跑不再重复生成"""
+    # 固定小数位: 跳过 float64 全精度 repr, 文件体积约减四成
+    # 直接按 utf-8-sig 写进字节缓冲, 省掉 str -> bytes 的整份拷贝
+    buf = io.BytesIO()
+    df.to_csv(buf, index=False, float_format='%.6f', encoding='utf-8-sig')
+    return buf.getvalue()
+
 # ----------------------------------------------------------------------------- 
 # 5. UI 界面
 # -----------------------------------------------------------------------------
@@ -195,7 +370,7 @@ st.sidebar.markdown("---")
 
 col_in1, col_in2 = st.sidebar.columns([2, 1])
 query = col_in1.text_input("代码/名称", value="002860", placeholder="输入代码或名称")
-days = col_in2.number_input("天数", 30, 2000, 365)
+days = col_in2.number_input("天数", 30, MAX_DAYS, 365)
 
 # 实时搜索
 target_code = None
@@ -204,7 +379,7 @@ target_name = None
 if query:
     with st.spinner("🔍 极速检索中..."):
         s_code, s_name, s_source = get_stock_info_fast(query)
-    if s_code:
+    if is_a_share_code(s_code):
         st.sidebar.success(f"已锁定: **{s_name}** ({s_code})")
         target_code = s_code
         target_name = s_name
@@ -212,7 +387,7 @@ if query:
         st.sidebar.error("❌ 未找到，请尝试手动输入")
         manual_code = st.sidebar.text_input("强制代码", value=query if query.isdigit() else "")
         manual_name = st.sidebar.text_input("强制名称", value="自选股")
-        if manual_code and len(manual_code) == 6:
+        if is_a_share_code(manual_code):
             target_code = manual_code
             target_name = manual_name
 
@@ -221,34 +396,40 @@ st.sidebar.markdown("---")
 if st.sidebar.button("🚀 生成 AI 分析数据", type="primary", disabled=not target_code):
     with st.spinner(f"正在拉取 {target_name} 数据并注入 AI 指令..."):
         df, err, logs = fetch_stock_history(target_code, days)
-        
+        csv_data = None
+        if not err:
+            # 1. 补全基础信息 + 2. 【核心】注入 AI Prompt 到新的一列
+            df = build_ai_dataset(df, target_code, target_name, days)
+            csv_data = export_csv(df)
+    st.session_state['last_run'] = (target_code, target_name, days)
+    st.session_state['last_result'] = (df, csv_data, err, logs)
+
+# 只在点击时拉数据; 之后的重跑 (改侧边栏/点下载) 直接用会话里存下的结果渲染, 不再请求数据源
+last_run = st.session_state.get('last_run')
+if last_run:
+    run_code, run_name, run_days = last_run
+    df, csv_data, err, logs = st.session_state['last_result']
+    if last_run != (target_code, target_name, days):
+        st.warning(f"参数已变更，请重新生成 (当前展示: {run_name} {run_code} 近 {run_days} 天)")
+
     if err:
         st.error(err)
         st.write(logs)
     else:
-        # 1. 补全基础信息
-        df['code'] = target_code
-        df['name'] = target_name
-        
-        # 2. 【核心】注入 AI Prompt 到新的一列
-        # 我们把 Prompt 放在第一列或者最后一列，Gemini 都能读到
-        prompt_text = generate_ai_prompt(target_name, target_code, days)
-        df['AI_ANALYSIS_PROMPT'] = prompt_text
-        
         # 3. 成功展示
         st.success(f"获取成功！AI 提示词已写入 CSV。")
         
-        last = df.iloc[-1]
+        last_close = df['close'].iat[-1]
+        last_pct = df['pct_chg'].iat[-1]
         c1, c2, c3, c4 = st.columns(4)
-        c1.metric("股票", target_name)
-        c2.metric("收盘", f"{last['close']:.2f}")
-        c3.metric("涨跌", f"{last.get('pct_chg', 0):.2f}%")
+        c1.metric("股票", run_name)
+        c2.metric("收盘", f"{last_close:.2f}")
+        c3.metric("涨跌", f"{last_pct:.2f}%")
         
         # 4. 下载
-        safe_name = str(target_name).replace("*", "").replace(":", "")
+        safe_name = str(run_name).replace("*", "").replace(":", "")
         file_time = datetime.datetime.now().strftime("%Y%m%d")
         file_name = f"【{safe_name}_{file_time}_AI版】.csv"
-        csv_data = df.to_csv(index=False).encode('utf-8-sig')
         
         st.download_button(
             label=f"📥 下载给 Gemini 的数据文件 ({file_name})",
@@ -261,4 +442,6 @@ if st.sidebar.button("🚀 生成 AI 分析数据", type="primary", disabled=not
         st.info("💡 使用方法：下载此 CSV 发送给 Gemini，它会自动读取 'AI_ANALYSIS_PROMPT' 列中的指令，为你生成深度报告。")
         
         st.markdown("### 📋 数据表预览")
-        st.dataframe(df.sort_values('trade_date', ascending=False), use_container_width=True, height=500)
+        # 预览不带提示词列: 每行重复的长文本会让 Arrow 传输体积成倍膨胀
+        preview = df.drop(columns=['AI_ANALYSIS_PROMPT']).sort_values('trade_date', ascending=False)
+        st.dataframe(preview, use_container_width=True, height=500)
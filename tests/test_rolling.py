@@ -0,0 +1,38 @@
+"""前缀和滑动指标与 pandas rolling 的对齐检查 (含 NaN 输入)"""
+import ast
+import pathlib
+
+import numpy as np
+import pandas as pd
+
+# app.py 是 Streamlit 脚本, 整体导入会渲染 UI 并发起搜索请求; 这里只取出待测的纯函数
+APP = pathlib.Path(__file__).resolve().parent.parent / "app.py"
+HELPERS = {"prefix_sum", "rolling_mean", "rolling_std"}
+tree = ast.parse(APP.read_text(encoding="utf-8"))
+tree.body = [n for n in tree.body if isinstance(n, ast.FunctionDef) and n.name in HELPERS]
+ns = {"np": np}
+exec(compile(tree, str(APP), "exec"), ns)
+
+def series_with_nan(n=2000, seed=0):
+    rng = np.random.default_rng(seed)
+    close = 20 + np.cumsum(rng.normal(0, .3, n))
+    close[100] = np.nan
+    close[500:503] = np.nan
+    close[900:950] = close[900]  # 停牌: 窗口内价格不变
+    return close
+
+def test_rolling_mean_matches_pandas():
+    close = series_with_nan()
+    sums = ns["prefix_sum"](close)
+    for w in [5, 10, 20, 60]:
+        expected = pd.Series(close).rolling(w).mean().to_numpy()
+        np.testing.assert_allclose(ns["rolling_mean"](sums, w), expected, rtol=1e-9, atol=1e-9)
+
+def test_rolling_std_matches_pandas():
+    close = series_with_nan()
+    expected = pd.Series(close).rolling(20).std().to_numpy()
+    np.testing.assert_allclose(ns["rolling_std"](close, 20), expected, rtol=1e-9, atol=1e-5)
+
+def test_window_longer_than_series():
+    close = np.arange(30, dtype=float)
+    assert np.isnan(ns["rolling_mean"](ns["prefix_sum"](close), 60)).all()